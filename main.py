@@ -1,41 +1,167 @@
 import os
+import sys
+import asyncio
 import time
-import traceback
+import random
+import hashlib
+import io
+import mimetypes
+import operator
+import atexit
+import queue
+import logging
+import logging.handlers
+import contextvars
+import uuid
+import email.utils
+from contextlib import asynccontextmanager
+from functools import lru_cache
 from typing import Optional, List
-from fastapi import FastAPI, UploadFile, File, HTTPException, Form
+import httpx
+import aiofiles
+from fastapi import FastAPI, UploadFile, File, HTTPException, Form, Depends, Request
 from fastapi.middleware.cors import CORSMiddleware
 from fastapi.staticfiles import StaticFiles
-from fastapi.responses import FileResponse
-from pydantic import BaseModel
+from fastapi.responses import FileResponse, ORJSONResponse, Response
+from pydantic import BaseModel, ConfigDict
 from dotenv import load_dotenv
 from google import genai
 from google.genai import types
+from celery import Celery
+from celery.result import AsyncResult
+import redis
+import redis.asyncio
+import shutil
 import tempfile
-import json
+import orjson
 
 # Load environment variables
 load_dotenv()
 
+# Correlation id of the current request, attached to every log record
+request_id_var = contextvars.ContextVar("request_id", default="-")
+
+
+class RequestIdFilter(logging.Filter):
+    """Add the current request's correlation id to log records"""
+    def filter(self, record):
+        record.cid = request_id_var.get()
+        return True
+
+
+# Logging: handlers only enqueue records, a listener thread writes them out,
+# so request handlers never block on stdout
+_log_queue = queue.SimpleQueue()
+_log_queue_handler = logging.handlers.QueueHandler(_log_queue)
+_log_queue_handler.addFilter(RequestIdFilter())
+_log_stream_handler = logging.StreamHandler()
+_log_stream_handler.setFormatter(logging.Formatter("%(asctime)s %(levelname)s %(name)s [%(cid)s]: %(message)s"))
+_log_listener = logging.handlers.QueueListener(_log_queue, _log_stream_handler)
+logging.basicConfig(level=os.getenv("LOG_LEVEL", "INFO").upper(), handlers=[_log_queue_handler])
+_log_listener.start()
+atexit.register(_log_listener.stop)
+
+log = logging.getLogger("gemini_rag")
+
 # Check for API key
 api_key = os.getenv("GEMINI_API_KEY")
 if not api_key:
-    print("\n" + "="*70)
-    print("ERROR: GEMINI_API_KEY not found!")
-    print("="*70)
-    print("\nPlease follow these steps:")
-    print("1. Get your API key from: https://aistudio.google.com/app/apikey")
-    print("2. Copy .env.example to .env")
-    print("3. Add your API key to the .env file:")
-    print("   GEMINI_API_KEY=your_api_key_here")
-    print("\nThen run the server again.")
-    print("="*70 + "\n")
+    log.error(
+        "GEMINI_API_KEY not found!\n\n"
+        "Please follow these steps:\n"
+        "1. Get your API key from: https://aistudio.google.com/app/apikey\n"
+        "2. Copy .env.example to .env\n"
+        "3. Add your API key to the .env file:\n"
+        "   GEMINI_API_KEY=your_api_key_here\n\n"
+        "Then run the server again."
+    )
     exit(1)
 
-# Initialize Gemini client
-client = genai.Client(api_key=api_key)
+# Gemini client setup
+# The SDK passes its own timeout on every request, overriding the httpx
+# client default, so the timeout has to be set in HttpOptions
+GEMINI_TIMEOUT_MS = 60_000
+
+
+def create_http_clients():
+    """Create pooled HTTP/2 transports shared by all Gemini calls"""
+    limits = httpx.Limits(max_connections=100, max_keepalive_connections=50)
+    return (
+        httpx.Client(http2=True, limits=limits),
+        httpx.AsyncClient(http2=True, limits=limits),
+    )
+
+
+def create_client(http_client, async_http_client):
+    """Create a Gemini client on top of the given transports"""
+    return genai.Client(
+        api_key=api_key,
+        http_options=types.HttpOptions(
+            timeout=GEMINI_TIMEOUT_MS,
+            httpx_client=http_client,
+            httpx_async_client=async_http_client,
+        ),
+    )
+
+
+@lru_cache(maxsize=1)
+def get_worker_client():
+    """Gemini client for Celery workers (one per worker process)"""
+    return create_client(*create_http_clients())
+
+# Redis (Celery broker/result backend, upload job tracking and caches).
+# Request handlers use the asyncio client; the sync client is for the Celery worker.
+REDIS_URL = os.getenv("REDIS_URL", "redis://localhost:6379/0")
+redis_client = redis.Redis.from_url(REDIS_URL, decode_responses=True)
+async_redis = redis.asyncio.Redis.from_url(REDIS_URL, decode_responses=True)
+
+# Celery app for long-running background work.
+# Run a worker with: celery -A main.celery_app worker -Q uploads
+celery_app = Celery("gemini_rag", broker=REDIS_URL, backend=REDIS_URL)
+celery_app.conf.task_routes = {
+    "uploads.poll_upload": {"queue": "uploads"},
+}
+
+# Upload job records expire together with their Celery results
+JOB_TTL = 24 * 60 * 60  # seconds
+celery_app.conf.result_expires = JOB_TTL
+
+
+def set_job_state(job_id, state, error=None):
+    """Record an upload job's state in its Redis hash (used by the Celery worker)"""
+    fields = {"state": state}
+    if error:
+        fields["error"] = error
+    pipe = redis_client.pipeline()
+    pipe.hset(f"upload_jobs:{job_id}", mapping=fields)
+    pipe.expire(f"upload_jobs:{job_id}", JOB_TTL)
+    pipe.execute()
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    """Create the shared Gemini client on startup and close its connections on shutdown"""
+    http_client, async_http_client = create_http_clients()
+    app.state.client = create_client(http_client, async_http_client)
+    try:
+        yield
+    finally:
+        http_client.close()
+        await async_http_client.aclose()
+        await async_redis.aclose()
+
+
+def get_client(request: Request) -> genai.Client:
+    """Dependency returning the shared Gemini client"""
+    return request.app.state.client
+
 
 # Initialize FastAPI app
-app = FastAPI(title="Gemini RAG with File Search", version="1.0.0")
+app = FastAPI(
+    title="Gemini RAG with File Search",
+    version="1.0.0",
+    lifespan=lifespan,
+    default_response_class=ORJSONResponse
+)
 
 # CORS middleware
 app.add_middleware(
@@ -46,21 +172,38 @@ app.add_middleware(
     allow_headers=["*"],
 )
 
+# Request correlation ids
+@app.middleware("http")
+async def assign_request_id(request: Request, call_next):
+    """Tag each request with a short correlation id for logging"""
+    request_id = uuid.uuid4().hex[:8]
+    token = request_id_var.set(request_id)
+    try:
+        response = await call_next(request)
+        response.headers["X-Request-ID"] = request_id
+        return response
+    finally:
+        request_id_var.reset(token)
+
 # Pydantic models
 class CreateStoreRequest(BaseModel):
+    model_config = ConfigDict(extra='forbid', frozen=True)
     display_name: str
 
 class QueryRequest(BaseModel):
+    model_config = ConfigDict(extra='forbid', frozen=True)
     query: str
     store_name: str
     metadata_filter: Optional[str] = None
 
 class MetadataItem(BaseModel):
+    model_config = ConfigDict(extra='forbid', frozen=True)
     key: str
     string_value: Optional[str] = None
     numeric_value: Optional[float] = None
 
 class UploadFileRequest(BaseModel):
+    model_config = ConfigDict(extra='forbid', frozen=True)
     store_name: str
     display_name: str
     metadata: Optional[List[MetadataItem]] = None
@@ -68,40 +211,287 @@ class UploadFileRequest(BaseModel):
     max_overlap_tokens: Optional[int] = 100
 
 
-# Helper function to poll operation
-async def wait_for_operation(operation):
-    """Poll operation until completion"""
-    max_attempts = 60  # 5 minutes max
-    attempt = 0
+# Polling settings for long-running operations
+POLL_TIMEOUT = 300  # 5 minutes max
+POLL_INITIAL_DELAY = 0.25  # seconds
+POLL_MAX_DELAY = 5.0  # seconds
+
+
+def next_poll_delay(delay):
+    """Exponential backoff with jitter, capped at POLL_MAX_DELAY"""
+    return min(delay * 1.7 + random.uniform(0, 0.1), POLL_MAX_DELAY)
+
+
+# Uploads are streamed to disk in chunks of this size
+UPLOAD_CHUNK_SIZE = 1 << 20  # 1 MB
+
+# Prefer RAM-backed tmpfs for temporary upload files when available
+_TMPDIR = "/dev/shm" if os.path.isdir("/dev/shm") and os.access("/dev/shm", os.W_OK) else tempfile.gettempdir()
+
+# Only use tmpfs for files under this fraction of its free space, leaving
+# headroom for other users of /dev/shm and for concurrent uploads
+TMPFS_MAX_FRACTION = 0.25
+
+
+def temp_dir_for(size):
+    """Pick a temp directory, falling back to disk if the file would crowd tmpfs"""
+    if (
+        _TMPDIR != tempfile.gettempdir()
+        and size is not None
+        and size < shutil.disk_usage(_TMPDIR).free * TMPFS_MAX_FRACTION
+    ):
+        return _TMPDIR
+    return tempfile.gettempdir()
+
+# Caches live in Redis so they stay coherent across uvicorn workers
+
+# Short-lived cache for the stores list (avoids a Gemini round-trip per UI refresh)
+STORES_CACHE_TTL = 5  # seconds
+STORES_CACHE_KEY = "cache:stores"
+
+# Per-store metadata, a hash keyed by store name
+STORE_META_KEY = "cache:store_meta"
+
+
+async def invalidate_stores_cache():
+    """Drop cached store data after a store is created or deleted"""
+    try:
+        await async_redis.delete(STORES_CACHE_KEY, STORE_META_KEY)
+    except redis.RedisError:
+        log.warning("Failed to invalidate stores cache", exc_info=True)
+
+
+# Cache of query responses, keyed by store name, the store's cache generation
+# and a hash of query + filter. Invalidating a store bumps its generation, so
+# old answers (including ones written by queries still in flight) are never
+# read again and simply expire.
+QUERY_CACHE_TTL = 300  # seconds
+
+
+def query_cache_key(store_name, generation, query, metadata_filter):
+    """Build a cache key for a query against a store"""
+    digest = hashlib.blake2b(f"{store_name}|{query}|{metadata_filter}".encode()).hexdigest()
+    return f"cache:query:{store_name}:{generation}:{digest}"
+
+
+def query_cache_generation_key(store_name):
+    """Key of the counter holding a store's query cache generation"""
+    return f"cache:query_gen:{store_name}"
+
+
+async def get_query_cache_generation(store_name):
+    """Current query cache generation of a store, or None if Redis is unavailable"""
+    try:
+        return int(await async_redis.get(query_cache_generation_key(store_name)) or 0)
+    except redis.RedisError:
+        log.warning("Query cache generation read failed", exc_info=True)
+        return None
+
+
+async def get_cached_query(cache_key):
+    """Read a cached query response, treating Redis errors as a miss"""
+    try:
+        return await async_redis.get(cache_key)
+    except redis.RedisError:
+        log.warning("Query cache read failed", exc_info=True)
+        return None
+
+
+async def cache_query(cache_key, result):
+    """Store a query response; Redis errors are logged and ignored"""
+    try:
+        await async_redis.set(cache_key, orjson.dumps(result), ex=QUERY_CACHE_TTL)
+    except redis.RedisError:
+        log.warning("Query cache write failed", exc_info=True)
+
+
+async def invalidate_query_cache(store_name):
+    """Drop cached answers for a store whose documents changed"""
+    try:
+        await async_redis.incr(query_cache_generation_key(store_name))
+    except redis.RedisError:
+        log.warning("Failed to invalidate query cache for %s", store_name, exc_info=True)
+
+
+def invalidate_query_cache_sync(store_name):
+    """invalidate_query_cache for the Celery worker"""
+    redis_client.incr(query_cache_generation_key(store_name))
+
+
+# Helper function to save an upload to disk
+async def save_to_temp_file(file: UploadFile):
+    """Stream an uploaded file to a temporary file and return its path"""
+    with tempfile.NamedTemporaryFile(
+        delete=False,
+        suffix=os.path.splitext(file.filename)[1],
+        dir=temp_dir_for(file.size)
+    ) as tmp_file:
+        tmp_file_path = tmp_file.name
+    
+    try:
+        # Stream in chunks so memory stays bounded for large files
+        async with aiofiles.open(tmp_file_path, 'wb') as out_file:
+            while chunk := await file.read(UPLOAD_CHUNK_SIZE):
+                await out_file.write(chunk)
+    except Exception:
+        os.unlink(tmp_file_path)
+        raise
+    
+    return tmp_file_path
+
+
+# Caps on concurrent outbound Gemini calls (per process). Uploads stream whole
+# file bodies, so they get their own smaller limit and can't starve queries.
+GEMINI_MAX_CONCURRENCY = int(os.getenv("GEMINI_MAX_CONCURRENCY", "16"))
+GEMINI_MAX_UPLOADS = int(os.getenv("GEMINI_MAX_UPLOADS", "4"))
+
+
+class Limiter:
+    """Semaphore that also counts in-flight and waiting callers for /metrics"""
+    def __init__(self, limit):
+        self.limit = limit
+        self.in_flight = 0
+        self.waiting = 0
+        self._sem = asyncio.Semaphore(limit)
+    
+    @asynccontextmanager
+    async def slot(self):
+        """Hold one slot for the duration of the block"""
+        self.waiting += 1
+        try:
+            await self._sem.acquire()
+        finally:
+            self.waiting -= 1
+        
+        self.in_flight += 1
+        try:
+            yield
+        finally:
+            self.in_flight -= 1
+            self._sem.release()
+    
+    def stats(self):
+        """Current limit and usage"""
+        return {
+            "max_concurrency": self.limit,
+            "in_flight": self.in_flight,
+            "waiting": self.waiting
+        }
+
+
+_gemini_limiter = Limiter(GEMINI_MAX_CONCURRENCY)
+_upload_limiter = Limiter(GEMINI_MAX_UPLOADS)
+
+
+def gemini_slot():
+    """Hold one of the limited outbound Gemini call slots"""
+    return _gemini_limiter.slot()
+
+
+def upload_slot():
+    """Hold one of the limited file upload slots"""
+    return _upload_limiter.slot()
+
+
+# Background task to poll an upload/indexing operation
+@celery_app.task(name="uploads.poll_upload", bind=True)
+def poll_upload(self, operation_name: str, store_name: str):
+    """Poll an upload operation until indexing completes (runs in a Celery worker)"""
+    set_job_state(self.request.id, "STARTED")
+    try:
+        result = _poll_upload_operation(operation_name, store_name)
+    except Exception as e:
+        set_job_state(self.request.id, "FAILURE", error=str(e))
+        raise
+    set_job_state(self.request.id, "SUCCESS")
+    return result
+
+
+def _poll_upload_operation(operation_name: str, store_name: str):
+    """Wait for an upload operation to finish, raising if it fails or times out"""
+    client = get_worker_client()
+    deadline = time.monotonic() + POLL_TIMEOUT
+    delay = POLL_INITIAL_DELAY
+    
+    operation = client.operations.get(
+        types.UploadToFileSearchStoreOperation(name=operation_name)
+    )
     
-    while not operation.done and attempt < max_attempts:
-        await asyncio.sleep(5)
+    while not operation.done and time.monotonic() < deadline:
+        time.sleep(delay)
+        delay = next_poll_delay(delay)
         operation = client.operations.get(operation)
-        attempt += 1
     
     if not operation.done:
-        raise HTTPException(status_code=408, detail="Operation timed out")
+        raise TimeoutError(f"Upload operation timed out: {operation_name}")
     
-    return operation
+    if operation.error:
+        raise RuntimeError(f"Upload operation failed: {operation.error}")
+    
+    # Answers cached while the file was indexing are now stale
+    invalidate_query_cache_sync(store_name)
+    
+    return {"name": operation.name, "done": operation.done}
+
+
+# Cache validators for the main page, computed once at startup
+INDEX_PATH = "static/index.html"
+_INDEX_MTIME = int(os.path.getmtime(INDEX_PATH))
+with open(INDEX_PATH, "rb") as index_file:
+    _INDEX_ETAG = '"' + hashlib.md5(index_file.read(), usedforsecurity=False).hexdigest() + '"'
+_INDEX_HEADERS = {
+    "ETag": _INDEX_ETAG,
+    "Last-Modified": email.utils.formatdate(_INDEX_MTIME, usegmt=True),
+    "Cache-Control": "public, max-age=60"
+}
+
+
+def etag_matches(request: Request, etag):
+    """Whether the request's If-None-Match header matches an ETag (weak comparison)"""
+    if_none_match = request.headers.get("if-none-match")
+    if if_none_match is None:
+        return False
+    tags = [tag.strip().removeprefix("W/") for tag in if_none_match.split(",")]
+    return "*" in tags or etag in tags
+
+
+def index_not_modified(request: Request):
+    """Whether the client's cached copy of the main page is still current"""
+    # If-None-Match takes precedence over If-Modified-Since
+    if "if-none-match" in request.headers:
+        return etag_matches(request, _INDEX_ETAG)
+    
+    if_modified_since = request.headers.get("if-modified-since")
+    if if_modified_since:
+        try:
+            return email.utils.parsedate_to_datetime(if_modified_since).timestamp() >= _INDEX_MTIME
+        except (TypeError, ValueError):
+            return False
+    
+    return False
 
 
 # API Endpoints
 
-@app.get("/")
-async def read_root():
+@app.api_route("/", methods=["GET", "HEAD"])
+async def read_root(request: Request):
     """Serve the main HTML page"""
-    return FileResponse("static/index.html")
+    if index_not_modified(request):
+        return Response(status_code=304, headers=_INDEX_HEADERS)
+    return FileResponse(INDEX_PATH, headers=_INDEX_HEADERS)
 
 
 @app.post("/api/stores/create")
-async def create_store(request: CreateStoreRequest):
+async def create_store(request: CreateStoreRequest, client: genai.Client = Depends(get_client)):
     """Create a new File Search store"""
     try:
-        print(f"Creating store with name: {request.display_name}")
-        file_search_store = client.file_search_stores.create(
-            config={'display_name': request.display_name}
-        )
-        print(f"Store created successfully: {file_search_store.name}")
+        log.info("Creating store with name: %s", request.display_name)
+        async with gemini_slot():
+            file_search_store = await client.aio.file_search_stores.create(
+                config={'display_name': request.display_name}
+            )
+        log.info("Store created successfully: %s", file_search_store.name)
+        await invalidate_stores_cache()
         return {
             "success": True,
             "store": {
@@ -111,37 +501,75 @@ async def create_store(request: CreateStoreRequest):
             }
         }
     except Exception as e:
-        print(f"Error creating store: {str(e)}")
-        print(traceback.format_exc())
+        log.exception("Error creating store")
         raise HTTPException(status_code=500, detail=f"Failed to create store: {str(e)}")
 
 
 @app.get("/api/stores/list")
-async def list_stores():
+async def list_stores(request: Request, response: Response, client: genai.Client = Depends(get_client)):
     """List all File Search stores"""
     try:
-        print("Listing all stores...")
-        stores = []
-        for store in client.file_search_stores.list():
-            stores.append({
-                "name": store.name,
-                "display_name": store.display_name,
-                "create_time": str(store.create_time) if hasattr(store, 'create_time') else None
-            })
-        print(f"Found {len(stores)} stores")
-        return {"success": True, "stores": stores}
+        try:
+            cached = await async_redis.get(STORES_CACHE_KEY)
+        except redis.RedisError:
+            log.warning("Stores cache read failed", exc_info=True)
+            cached = None
+        
+        if cached is not None:
+            cached = orjson.loads(cached)
+        else:
+            log.info("Listing all stores...")
+            async with gemini_slot():
+                stores = [
+                    {
+                        "name": store.name,
+                        "display_name": store.display_name,
+                        "create_time": str(store.create_time) if getattr(store, 'create_time', None) else None
+                    }
+                    async for store in await client.aio.file_search_stores.list()
+                ]
+            log.info("Found %d stores", len(stores))
+            
+            etag = '"' + hashlib.blake2b(orjson.dumps(stores)).hexdigest() + '"'
+            cached = {"stores": stores, "etag": etag}
+            
+            try:
+                pipe = async_redis.pipeline()
+                pipe.set(STORES_CACHE_KEY, orjson.dumps(cached), ex=STORES_CACHE_TTL)
+                pipe.delete(STORE_META_KEY)
+                if stores:
+                    pipe.hset(STORE_META_KEY, mapping={store["name"]: orjson.dumps(store) for store in stores})
+                await pipe.execute()
+            except redis.RedisError:
+                log.warning("Stores cache write failed", exc_info=True)
+        
+        etag = cached["etag"]
+        if etag_matches(request, etag):
+            return Response(status_code=304, headers={"ETag": etag})
+        
+        response.headers["ETag"] = etag
+        return {"success": True, "stores": cached["stores"]}
     except Exception as e:
-        print(f"Error listing stores: {str(e)}")
-        print(traceback.format_exc())
+        log.exception("Error listing stores")
         raise HTTPException(status_code=500, detail=f"Failed to list stores: {str(e)}")
 
 
 @app.delete("/api/stores/{store_id}")
-async def delete_store(store_id: str, force: bool = True):
+async def delete_store(store_id: str, force: bool = True, client: genai.Client = Depends(get_client)):
     """Delete a File Search store"""
     try:
         store_name = f"fileSearchStores/{store_id}" if not store_id.startswith("fileSearchStores/") else store_id
-        client.file_search_stores.delete(name=store_name, config={'force': force})
+        async with gemini_slot():
+            await client.aio.file_search_stores.delete(name=store_name, config={'force': force})
+        await invalidate_stores_cache()
+        await invalidate_query_cache(store_name)
+        
+        # Forget upload jobs for the deleted store (they expire anyway if this fails)
+        try:
+            job_ids = await async_redis.smembers(f"store_jobs:{store_name}")
+            await async_redis.delete(f"store_jobs:{store_name}", *(f"upload_jobs:{job_id}" for job_id in job_ids))
+        except redis.RedisError:
+            log.warning("Failed to clear upload jobs for %s", store_name, exc_info=True)
         return {"success": True, "message": "Store deleted successfully"}
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"Failed to delete store: {str(e)}")
@@ -154,23 +582,26 @@ async def upload_file(
     display_name: str = Form(...),
     metadata: Optional[str] = Form(None),
     max_tokens_per_chunk: int = Form(800),
-    max_overlap_tokens: int = Form(100)
+    max_overlap_tokens: int = Form(100),
+    client: genai.Client = Depends(get_client)
 ):
     """Upload a file directly to File Search store"""
     try:
-        # Save uploaded file temporarily
-        with tempfile.NamedTemporaryFile(delete=False, suffix=os.path.splitext(file.filename)[1]) as tmp_file:
-            content = await file.read()
-            tmp_file.write(content)
-            tmp_file_path = tmp_file.name
+        tmp_file_path = None
         
         try:
+            if isinstance(file.file, io.IOBase):
+                # Starlette has already spooled the upload; pass the stream
+                # straight to the SDK instead of copying it to another file
+                upload_source = file.file
+                upload_source.seek(0)
+            else:
+                # SpooledTemporaryFile is only an IOBase on Python 3.11+
+                tmp_file_path = await save_to_temp_file(file)
+                upload_source = tmp_file_path
+            
             # Parse metadata if provided
-            custom_metadata = []
-            if metadata:
-                metadata_list = json.loads(metadata)
-                for item in metadata_list:
-                    custom_metadata.append(item)
+            custom_metadata = orjson.loads(metadata) if metadata else []
             
             # Upload to File Search store
             config = {
@@ -186,124 +617,245 @@ async def upload_file(
             if custom_metadata:
                 config['custom_metadata'] = custom_metadata
             
-            operation = client.file_search_stores.upload_to_file_search_store(
-                file=tmp_file_path,
-                file_search_store_name=store_name,
-                config=config
-            )
+            # The SDK can't guess the type of a stream, so provide it
+            if tmp_file_path is None:
+                config['mime_type'] = (
+                    mimetypes.guess_type(file.filename)[0]
+                    or file.content_type
+                    or 'application/octet-stream'
+                )
+            
+            async with upload_slot():
+                if tmp_file_path is None:
+                    # The SDK reads streams with blocking read() calls, even
+                    # from its async client, so upload them from a thread
+                    operation = await asyncio.to_thread(
+                        client.file_search_stores.upload_to_file_search_store,
+                        file=upload_source,
+                        file_search_store_name=store_name,
+                        config=config
+                    )
+                else:
+                    operation = await client.aio.file_search_stores.upload_to_file_search_store(
+                        file=upload_source,
+                        file_search_store_name=store_name,
+                        config=config
+                    )
             
-            # Poll operation until complete
-            import asyncio
-            max_attempts = 60
-            attempt = 0
+            # Track job -> operation so clients can reconcile later. Written
+            # before the task is queued so the worker's state updates win.
+            job_id = uuid.uuid4().hex
+            pipe = async_redis.pipeline()
+            pipe.hset(f"upload_jobs:{job_id}", mapping={
+                "operation": operation.name,
+                "store_name": store_name,
+                "display_name": display_name,
+                "state": "PENDING"
+            })
+            pipe.expire(f"upload_jobs:{job_id}", JOB_TTL)
+            pipe.sadd(f"store_jobs:{store_name}", job_id)
+            pipe.expire(f"store_jobs:{store_name}", JOB_TTL)
+            await pipe.execute()
             
-            while not operation.done and attempt < max_attempts:
-                await asyncio.sleep(5)
-                operation = client.operations.get(operation)
-                attempt += 1
+            # Hand indexing off to the background worker (publishing blocks on the broker)
+            await asyncio.to_thread(poll_upload.apply_async, (operation.name, store_name), task_id=job_id)
             
-            if not operation.done:
-                raise HTTPException(status_code=408, detail="Upload operation timed out")
+            # New documents change retrieval results
+            await invalidate_query_cache(store_name)
             
             return {
                 "success": True,
-                "message": "File uploaded and indexed successfully",
-                "operation": {
-                    "name": operation.name,
-                    "done": operation.done
-                }
+                "message": "File uploaded, indexing in progress",
+                "job_id": job_id,
+                "operation": operation.name
             }
         
         finally:
             # Clean up temporary file
-            if os.path.exists(tmp_file_path):
+            if tmp_file_path and os.path.exists(tmp_file_path):
                 os.unlink(tmp_file_path)
     
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"Failed to upload file: {str(e)}")
 
 
-@app.post("/api/query")
-async def query_documents(request: QueryRequest):
-    """Query documents using File Search"""
+async def job_state(job_id, job):
+    """State of an upload job, preferring the state recorded by the worker"""
+    state = job.get("state", "PENDING")
+    if state != "PENDING":
+        return state
+    # Catches jobs revoked or lost before the worker recorded anything.
+    # The result backend client is synchronous, so keep it off the event loop.
+    return await asyncio.to_thread(lambda: AsyncResult(job_id, app=celery_app).state)
+
+
+@app.get("/api/jobs/{job_id}")
+async def get_job(job_id: str):
+    """Get the status of a background upload job"""
+    try:
+        job = await async_redis.hgetall(f"upload_jobs:{job_id}")
+        if not job:
+            raise HTTPException(status_code=404, detail="Job not found")
+        
+        response = {
+            "success": True,
+            "job_id": job_id,
+            "state": await job_state(job_id, job),
+            "operation": job.get("operation"),
+            "store_name": job.get("store_name"),
+            "display_name": job.get("display_name")
+        }
+        if job.get("error"):
+            response["error"] = job["error"]
+        return response
+    
+    except HTTPException:
+        raise
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=f"Failed to get job status: {str(e)}")
+
+
+# Grounding metadata serialization
+_get_web_fields = operator.attrgetter('uri', 'title')
+_get_context_fields = operator.attrgetter('uri', 'title', 'text')
+_get_segment_fields = operator.attrgetter('start_index', 'end_index', 'text')
+
+
+def _web_dict(chunk):
+    web = getattr(chunk, 'web', None)
+    if not web:
+        return None
+    uri, title = _get_web_fields(web)
+    return {'uri': uri, 'title': title}
+
+
+def _context_dict(chunk):
+    context = getattr(chunk, 'retrieved_context', None)
+    if not context:
+        return None
+    uri, title, text = _get_context_fields(context)
+    return {'uri': uri, 'title': title, 'text': text}
+
+
+def _segment_dict(support):
+    segment = getattr(support, 'segment', None)
+    if not segment:
+        return None
+    start_index, end_index, text = _get_segment_fields(segment)
+    return {'start_index': start_index, 'end_index': end_index, 'text': text}
+
+
+def _serialize_chunk(chunk):
+    """Convert a grounding chunk into a JSON-friendly dict, dropping empty parts"""
+    return {k: v for k, v in (
+        ('web', _web_dict(chunk)),
+        ('retrieved_context', _context_dict(chunk)),
+    ) if v}
+
+
+def _serialize_support(support):
+    """Convert a grounding support into a JSON-friendly dict, dropping empty parts"""
+    return {k: v for k, v in (
+        ('segment', _segment_dict(support)),
+        ('grounding_chunk_indices', list(getattr(support, 'grounding_chunk_indices', None) or ())),
+        ('confidence_scores', list(getattr(support, 'confidence_scores', None) or ())),
+    ) if v}
+
+
+def serialize_grounding_metadata(metadata):
+    """Extract citations from a candidate's grounding metadata"""
+    if not metadata:
+        return None
+    
+    result = {
+        "grounding_chunks": [
+            data for data in map(_serialize_chunk, getattr(metadata, 'grounding_chunks', None) or ()) if data
+        ]
+    }
+    
+    supports = getattr(metadata, 'grounding_supports', None)
+    if supports:
+        result["grounding_supports"] = [data for data in map(_serialize_support, supports) if data]
+    
+    return result
+
+
+# Circuit breaker: after repeated 503s, fail fast instead of queueing more retries
+BREAKER_THRESHOLD = 5  # consecutive overload errors
+BREAKER_COOLDOWN = 30  # seconds
+_breaker = {"failures": 0, "open_until": 0.0}
+_breaker_lock = asyncio.Lock()
+
+
+def breaker_is_open():
+    """Whether queries should currently fail fast"""
+    return time.monotonic() < _breaker["open_until"]
+
+
+async def record_overload():
+    """Count an overload error and open the breaker once the threshold is hit"""
+    async with _breaker_lock:
+        _breaker["failures"] += 1
+        if _breaker["failures"] >= BREAKER_THRESHOLD:
+            _breaker["open_until"] = time.monotonic() + BREAKER_COOLDOWN
+            log.warning("Circuit breaker open for %d seconds after %d overload errors",
+                        BREAKER_COOLDOWN, _breaker["failures"])
+
+
+async def record_query_success():
+    """Close the breaker after a successful call"""
+    async with _breaker_lock:
+        _breaker["failures"] = 0
+
+
+@lru_cache(maxsize=256)
+def build_query_config(store_name: str, metadata_filter: Optional[str] = None):
+    """Build the File Search generation config for a store (cached, never mutated)"""
+    return types.GenerateContentConfig(
+        tools=[
+            types.Tool(
+                file_search=types.FileSearch(
+                    file_search_store_names=[store_name],
+                    metadata_filter=metadata_filter
+                )
+            )
+        ]
+    )
+
+
+async def run_query(client, store_name, query, metadata_filter=None):
+    """Run a File Search query against Gemini, retrying while the model is overloaded"""
     max_retries = 3
     retry_delay = 2  # seconds
     
     for attempt in range(max_retries):
         try:
-            print(f"Querying store: {request.store_name} with query: {request.query} (attempt {attempt + 1}/{max_retries})")
-            
-            # Build config
-            config = types.GenerateContentConfig(
-                tools=[
-                    types.Tool(
-                        file_search=types.FileSearch(
-                            file_search_store_names=[request.store_name]
-                        )
-                    )
-                ]
-            )
+            if log.isEnabledFor(logging.DEBUG):
+                log.debug("Querying store: %s with query: %s (attempt %d/%d)", store_name, query, attempt + 1, max_retries)
             
-            # Add metadata filter if provided
-            if request.metadata_filter:
-                config.tools[0].file_search.metadata_filter = request.metadata_filter
+            config = build_query_config(store_name, metadata_filter)
             
             # Generate content
-            response = client.models.generate_content(
-                model="gemini-2.5-flash",
-                contents=request.query,
-                config=config
-            )
+            async with gemini_slot():
+                response = await client.aio.models.generate_content(
+                    model="gemini-2.5-flash",
+                    contents=query,
+                    config=config
+                )
             
-            print(f"Response received: {response.text[:100]}...")
+            if log.isEnabledFor(logging.DEBUG):
+                log.debug("Response received: %s...", response.text[:100])
             
             # Extract grounding metadata and citations
             grounding_metadata = None
+            if response.candidates:
+                grounding_metadata = serialize_grounding_metadata(
+                    getattr(response.candidates[0], 'grounding_metadata', None)
+                )
             
-            if response.candidates and len(response.candidates) > 0:
-                candidate = response.candidates[0]
-                if hasattr(candidate, 'grounding_metadata') and candidate.grounding_metadata:
-                    grounding_metadata = {
-                        "grounding_chunks": []
-                    }
-                    
-                    # Check if grounding_chunks exists and is not None
-                    if hasattr(candidate.grounding_metadata, 'grounding_chunks') and candidate.grounding_metadata.grounding_chunks:
-                        for chunk in candidate.grounding_metadata.grounding_chunks:
-                            chunk_data = {}
-                            if hasattr(chunk, 'web') and chunk.web:
-                                chunk_data['web'] = {
-                                    'uri': chunk.web.uri if hasattr(chunk.web, 'uri') else None,
-                                    'title': chunk.web.title if hasattr(chunk.web, 'title') else None
-                                }
-                            if hasattr(chunk, 'retrieved_context') and chunk.retrieved_context:
-                                chunk_data['retrieved_context'] = {
-                                    'uri': chunk.retrieved_context.uri if hasattr(chunk.retrieved_context, 'uri') else None,
-                                    'title': chunk.retrieved_context.title if hasattr(chunk.retrieved_context, 'title') else None,
-                                    'text': chunk.retrieved_context.text if hasattr(chunk.retrieved_context, 'text') else None
-                                }
-                            if chunk_data:  # Only add if we have data
-                                grounding_metadata['grounding_chunks'].append(chunk_data)
-                    
-                    # Check if grounding_supports exists and is not None
-                    if hasattr(candidate.grounding_metadata, 'grounding_supports') and candidate.grounding_metadata.grounding_supports:
-                        grounding_metadata['grounding_supports'] = []
-                        for support in candidate.grounding_metadata.grounding_supports:
-                            support_data = {}
-                            if hasattr(support, 'segment') and support.segment:
-                                support_data['segment'] = {
-                                    'start_index': support.segment.start_index if hasattr(support.segment, 'start_index') else None,
-                                    'end_index': support.segment.end_index if hasattr(support.segment, 'end_index') else None,
-                                    'text': support.segment.text if hasattr(support.segment, 'text') else None
-                                }
-                            if hasattr(support, 'grounding_chunk_indices') and support.grounding_chunk_indices:
-                                support_data['grounding_chunk_indices'] = list(support.grounding_chunk_indices)
-                            if hasattr(support, 'confidence_scores') and support.confidence_scores:
-                                support_data['confidence_scores'] = list(support.confidence_scores)
-                            if support_data:  # Only add if we have data
-                                grounding_metadata['grounding_supports'].append(support_data)
+            log.debug("Grounding metadata extracted: %s", grounding_metadata is not None)
             
-            print(f"Grounding metadata extracted: {grounding_metadata is not None}")
+            await record_query_success()
             
             return {
                 "success": True,
@@ -314,13 +866,14 @@ async def query_documents(request: QueryRequest):
         
         except Exception as e:
             error_str = str(e)
-            print(f"Query error (attempt {attempt + 1}/{max_retries}): {error_str}")
+            log.warning("Query error (attempt %d/%d): %s", attempt + 1, max_retries, error_str)
             
             # Check if it's a 503 error (model overloaded)
             if "503" in error_str or "UNAVAILABLE" in error_str or "overloaded" in error_str.lower():
-                if attempt < max_retries - 1:  # Don't sleep on last attempt
-                    print(f"Model overloaded, retrying in {retry_delay} seconds...")
-                    import asyncio
+                await record_overload()
+                # Don't sleep on last attempt, or once the breaker has tripped
+                if attempt < max_retries - 1 and not breaker_is_open():
+                    log.info("Model overloaded, retrying in %d seconds...", retry_delay)
                     await asyncio.sleep(retry_delay)
                     retry_delay *= 2  # Exponential backoff
                     continue
@@ -330,14 +883,93 @@ async def query_documents(request: QueryRequest):
                         detail="The AI model is currently overloaded. Please try again in a few moments."
                     )
             else:
-                # For other errors, print traceback and fail immediately
-                print(traceback.format_exc())
+                # For other errors, log traceback and fail immediately
+                log.exception("Query failed")
                 raise HTTPException(status_code=500, detail=f"Query failed: {error_str}")
     
     # Should never reach here, but just in case
     raise HTTPException(status_code=500, detail="Query failed after multiple retries")
 
 
+# Single-flight: identical queries already in flight share one Gemini call.
+# Maps (store_name, query, metadata_filter) -> (task, request id that started it)
+_inflight_queries = {}
+
+
+def _forget_inflight_query(key, task):
+    entry = _inflight_queries.get(key)
+    if entry is not None and entry[0] is task:
+        del _inflight_queries[key]
+    # Mark the exception as retrieved in case every waiter went away
+    if not task.cancelled():
+        task.exception()
+
+
+async def run_query_once(client, store_name, query, metadata_filter=None):
+    """Run a query, joining an identical in-flight one instead of calling Gemini again"""
+    key = (store_name, query, metadata_filter)
+    entry = _inflight_queries.get(key)
+    if entry is None:
+        # create_task copies this request's context, so the call logs with our correlation id
+        task = asyncio.create_task(run_query(client, store_name, query, metadata_filter))
+        _inflight_queries[key] = (task, request_id_var.get())
+        task.add_done_callback(lambda done: _forget_inflight_query(key, done))
+    else:
+        task, leader_id = entry
+        log.debug("Joining in-flight query started by request %s", leader_id)
+    # Shield so one caller disconnecting doesn't cancel the call for the others
+    return await asyncio.shield(task)
+
+
+@app.post("/api/query")
+async def query_documents(
+    request: QueryRequest,
+    response: Response,
+    client: genai.Client = Depends(get_client)
+):
+    """Query documents using File Search"""
+    cache_control = f"public, max-age={QUERY_CACHE_TTL}"
+    response.headers["Cache-Control"] = cache_control
+    
+    # Read the generation before calling Gemini, so an answer that races with
+    # an invalidation is written under the old generation and never served
+    generation = await get_query_cache_generation(request.store_name)
+    cache_key = None
+    if generation is not None:
+        cache_key = query_cache_key(request.store_name, generation, request.query, request.metadata_filter)
+        cached = await get_cached_query(cache_key)
+        if cached is not None:
+            # Already encoded JSON - send it as is
+            return Response(content=cached, media_type="application/json", headers={"Cache-Control": cache_control})
+    
+    if breaker_is_open():
+        raise HTTPException(
+            status_code=503,
+            detail="Circuit open, try again later",
+            headers={"Retry-After": str(int(_breaker["open_until"] - time.monotonic()) + 1)}
+        )
+    
+    result = await run_query_once(client, request.store_name, request.query, request.metadata_filter)
+    
+    if cache_key is not None:
+        await cache_query(cache_key, result)
+    return result
+
+
+@app.get("/metrics")
+async def metrics():
+    """Report Gemini concurrency, circuit breaker and query coalescing state for this worker"""
+    return {
+        "gemini": _gemini_limiter.stats(),
+        "uploads": _upload_limiter.stats(),
+        "circuit_breaker": {
+            "open": breaker_is_open(),
+            "failures": _breaker["failures"]
+        },
+        "inflight_queries": len(_inflight_queries)
+    }
+
+
 @app.get("/api/documents/{store_id}")
 async def list_documents(store_id: str):
     """List documents in a File Search store"""
@@ -347,9 +979,31 @@ async def list_documents(store_id: str):
         
         # Note: The API might not have a direct list documents method
         # This is a placeholder - adjust based on actual API capabilities
+        
+        store_meta = await async_redis.hget(STORE_META_KEY, store_name)
+        
+        # Include background upload jobs so the UI can reconcile in-flight files
+        job_ids = list(await async_redis.smembers(f"store_jobs:{store_name}"))
+        pipe = async_redis.pipeline(transaction=False)
+        for job_id in job_ids:
+            pipe.hgetall(f"upload_jobs:{job_id}")
+        job_records = await pipe.execute() if job_ids else []
+        
+        jobs = []
+        for job_id, job in zip(job_ids, job_records):
+            if job:
+                jobs.append({
+                    "job_id": job_id,
+                    "state": await job_state(job_id, job),
+                    "operation": job.get("operation"),
+                    "display_name": job.get("display_name")
+                })
+        
         return {
             "success": True,
+            "store": orjson.loads(store_meta) if store_meta else None,
             "documents": documents,
+            "jobs": jobs,
             "message": "Document listing may require additional API methods"
         }
     
@@ -363,4 +1017,11 @@ app.mount("/static", StaticFiles(directory="static"), name="static")
 
 if __name__ == "__main__":
     import uvicorn
-    uvicorn.run(app, host="0.0.0.0", port=8000)
+    uvicorn.run(
+        "main:app",
+        host="0.0.0.0",
+        port=8000,
+        loop="asyncio" if sys.platform == "win32" else "uvloop",  # uvloop doesn't support Windows
+        http="httptools",
+        workers=int(os.getenv("WEB_CONCURRENCY", os.cpu_count() or 1))
+    )
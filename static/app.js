@@ -251,6 +251,10 @@ async function uploadFile(file) {
         const data = await response.json();
         
         if (data.success) {
+            progressFill.style.width = '95%';
+            uploadStatus.textContent = 'Indexing...';
+            await waitForJob(data.job_id);
+            
             progressFill.style.width = '100%';
             uploadStatus.textContent = 'File uploaded and indexed successfully!';
             uploadStatus.style.color = 'var(--success)';
@@ -281,6 +285,33 @@ async function uploadFile(file) {
     }
 }
 
+// Job states that mean the worker hasn't finished yet
+const JOB_ACTIVE_STATES = ['PENDING', 'RECEIVED', 'STARTED', 'RETRY'];
+const JOB_MAX_WAIT_MS = 10 * 60 * 1000;
+
+async function waitForJob(jobId) {
+    const deadline = Date.now() + JOB_MAX_WAIT_MS;
+    
+    while (Date.now() < deadline) {
+        const response = await fetch(`${API_BASE}/api/jobs/${jobId}`);
+        const data = await response.json();
+        
+        if (!response.ok) {
+            throw new Error(data.detail || 'Failed to get job status');
+        }
+        if (data.state === 'SUCCESS') {
+            return data;
+        }
+        if (!JOB_ACTIVE_STATES.includes(data.state)) {
+            throw new Error(data.error || `Indexing ${data.state.toLowerCase()}`);
+        }
+        
+        await new Promise(resolve => setTimeout(resolve, 2000));
+    }
+    
+    throw new Error('Timed out waiting for indexing - is the background worker running?');
+}
+
 // Chat Functions
 async function sendQuery() {
     const query = queryInput.value.trim();